@@ -8,7 +8,8 @@ module Database.Bloodhound.Raw (
   TermsCompositeAggBucket (..),
   advance,
   search,
-  searchHit,
+  msearch,
+  aggregation,
   settings,
   aggWithDocValues,
   mkAgg,
@@ -24,7 +25,6 @@ import Data.Aeson.Types qualified as Aeson
 import Data.Text qualified as Text
 import Data.Vector qualified as V
 import Database.Bloodhound qualified as BH
-import Json.Extras qualified as Json
 import Monocle.Prelude
 import Network.HTTP.Client qualified as HTTP
 import Network.HTTP.Types.Method qualified as HTTP
@@ -40,13 +40,23 @@ dispatch ::
   LByteString ->
   QS ->
   m BH.Reply
-dispatch method url body qs = do
+dispatch = dispatchWith "application/json"
+
+dispatchWith ::
+  BH.MonadBH m =>
+  ByteString ->
+  HTTP.Method ->
+  Text ->
+  LByteString ->
+  QS ->
+  m BH.Reply
+dispatchWith contentType method url body qs = do
   initReq <- liftIO $ HTTP.parseRequest (from url)
   let request =
         initReq
           { HTTP.method = method
           , HTTP.requestHeaders =
-              ("Content-Type", "application/json") : HTTP.requestHeaders initReq
+              ("Content-Type", contentType) : HTTP.requestHeaders initReq
           , HTTP.requestBody = HTTP.RequestBodyLBS body
           }
   manager <- BH.bhManager <$> BH.getBHEnv
@@ -126,26 +136,54 @@ search index body scrollRequest = do
     NoScroll -> []
     GetScroll x -> [("scroll", Just x)]
 
--- | A special purpose search implementation that uses the faster json-syntax
-searchHit ::
-  MonadBH m =>
+-- | A search that only returns the aggregations.
+-- The response is filtered by elastic to skip the hits and the shards stats.
+aggregation ::
+  (MonadBH m, MonadThrow m) =>
   Aeson.ToJSON body =>
   BH.IndexName ->
   body ->
-  m [Json.Value]
-searchHit index body = do
-  rawResp <- search' index body []
-  case decodeHits (Json.decodeThrow $ HTTP.responseBody rawResp) of
-    Just xs -> pure xs
-    Nothing -> error $ "Could not find hits in " <> show rawResp
+  m BH.AggregationResults
+aggregation index body = do
+  rawResp <- search' index body [("filter_path", Just "aggregations,error")]
+  let respBody = HTTP.responseBody rawResp
+  case Aeson.parseEither parseAggregations =<< Aeson.eitherDecode respBody of
+    Left err -> throwM $ BH.EsProtocolException (from err) respBody
+    Right x -> pure x
+ where
+  parseAggregations = Aeson.withObject "AggregationResponse" (.: "aggregations")
+
+-- | Run multiple searches in a single _msearch request.
+-- The responses are returned in the same order as the bodies.
+-- A failed search is reported in its response item, in that case an EsProtocolException is thrown.
+msearch ::
+  forall resp m body.
+  (MonadBH m, MonadThrow m) =>
+  (Aeson.ToJSON body, FromJSON resp) =>
+  BH.IndexName ->
+  [body] ->
+  m [resp]
+msearch (BH.IndexName index) bodies = do
+  BH.Server s <- BH.bhServer <$> BH.getBHEnv
+  let url = Text.intercalate "/" [s, index, "_msearch"]
+      method = HTTP.methodPost
+  rawResp <- dispatchWith "application/x-ndjson" method url payload []
+  let respBody = HTTP.responseBody rawResp
+  case Aeson.parseEither parseResponses =<< Aeson.eitherDecode respBody of
+    Left err -> throwM $ BH.EsProtocolException (from err) respBody
+    Right xs
+      | length xs /= length bodies -> throwM $ BH.EsProtocolException "Unexpected msearch responses count" respBody
+      | otherwise -> traverse decodeResponse xs
  where
-  decodeHits :: Json.Value -> Maybe [Json.Value]
-  decodeHits value = do
-    hits <- Json.getAttr "hits" =<< Json.getAttr "hits" value
-    fmap getSource <$> Json.getArray hits
-  getSource value = case Json.getAttr "_source" value of
-    Nothing -> error $ "No source found in: " <> show value
-    Just v -> v
+  -- The index is set in the url, thus each search header is empty
+  payload = mconcat $ concatMap (\body -> ["{}\n", Aeson.encode body, "\n"]) bodies
+  parseResponses = Aeson.withObject "MultiSearchResponse" (.: "responses")
+  decodeResponse :: Value -> m resp
+  decodeResponse value = case value of
+    Object obj | Just err <- KM.lookup "error" obj -> throwM $ BH.EsProtocolException "msearch failed" (Aeson.encode err)
+    _ -> case Aeson.parseEither parseJSON value of
+      Left err -> throwM $ BH.EsProtocolException (from err) (Aeson.encode value)
+      Right x -> pure x
 
 aggWithDocValues :: [(Text, Value)] -> Maybe BH.Query -> Value
 aggWithDocValues agg = mkAgg agg (Just dv)
@@ -1,3 +1,5 @@
+{-# LANGUAGE DeriveTraversable #-}
+
 -- | Monocle queries
 -- The goal of this module is to transform 'Query' into list of items
 module Monocle.Backend.Queries where
@@ -5,10 +7,10 @@ module Monocle.Backend.Queries where
 import Data.Aeson (Value (Object), (.:), (.:?))
 import Data.Aeson qualified as Aeson
 import Data.Aeson.Types qualified as Aeson
-import Data.HashMap.Strict qualified as HM
 import Data.List qualified
 import Data.Map qualified as Map
 import Data.Ord qualified
+import Data.Set qualified as Set
 import Data.String.Interpolate (i, iii)
 import Data.Time (UTCTime (UTCTime), addDays, addGregorianMonthsClip, addGregorianYearsClip, secondsToNominalDiffTime)
 import Data.Time.Clock (secondsToDiffTime)
@@ -16,7 +18,6 @@ import Data.Vector qualified as V
 import Database.Bloodhound qualified as BH
 import Database.Bloodhound.Raw (TermsCompositeAggBucket)
 import Database.Bloodhound.Raw qualified as BHR
-import Json.Extras qualified as Json
 import Monocle.Backend.Documents (EChange (..), EChangeEvent (..), EChangeState (..), EDocType (..), EError, EErrorData, allEventTypes, eeErrorData)
 import Monocle.Config qualified as Config
 import Monocle.Prelude
@@ -63,12 +64,6 @@ doAdvanceScrollBH scroll = do
   measureQueryM (Aeson.object ["scrolling" .= ("advancing..." :: Text)]) do
     esAdvance scroll
 
-doSearchHitBH :: (QEffects es, ToJSON body) => body -> Eff es [Json.Value]
-doSearchHitBH body = do
-  measureQueryM body do
-    index <- getIndexName
-    esSearchHit index body
-
 -- | Call the count endpoint
 doCountBH :: QEffects es => BH.Query -> Eff es Count
 doCountBH body = do
@@ -79,6 +74,35 @@ doCountBH body = do
       Left e -> error $ show e
       Right x -> pure $ naturalToCount (BH.crCount x)
 
+-- | The total hits of a search response
+newtype TotalHits = TotalHits {unTotalHits :: Count}
+
+instance FromJSON TotalHits where
+  parseJSON = Aeson.withObject "SearchResponse" \obj -> do
+    hits <- obj .: "hits"
+    total <- hits .: "total"
+    TotalHits <$> total .: "value"
+
+-- | Call the _msearch endpoint to count the documents matching each query in a single request
+doMultiCountBH :: (QEffects es, Traversable t) => t BH.Query -> Eff es (t Count)
+doMultiCountBH queries = do
+  measureQueryM (toList queries) do
+    index <- getIndexName
+    resps <- esMultiSearch index (countBody <$> toList queries)
+    -- The responses are in the same order as the queries
+    pure $ evaluatingState (unTotalHits <$> resps) (traverse (const nextCount) queries)
+ where
+  countBody query =
+    Aeson.object
+      [ "size" .= (0 :: Word)
+      , "track_total_hits" .= True
+      , "query" .= query
+      ]
+  -- esMultiSearch ensures there is one response per query
+  nextCount = state \case
+    count : counts -> (count, counts)
+    [] -> error "Missing msearch response"
+
 -- | Call _delete_by_query endpoint
 doDeleteByQueryBH :: QEffects es => BH.Query -> Eff es ()
 doDeleteByQueryBH body = do
@@ -93,11 +117,15 @@ doDeleteByQueryBH body = do
 
 -- | scan search the result using a streaming
 scanSearch :: QEffects es => FromJSONField resp => Stream (Of (BH.Hit resp)) (Eff es) ()
-scanSearch = do
+scanSearch = scanSearchWith id
+
+-- | scan search with a modified search request, e.g. to filter the returned source
+scanSearchWith :: QEffects es => FromJSONField resp => (BH.Search -> BH.Search) -> Stream (Of (BH.Hit resp)) (Eff es) ()
+scanSearchWith modifySearch = do
   resp <- lift do
     query <- getQueryBH
-    let search = (BH.mkSearch query Nothing) {BH.size = BH.Size 5000}
-    doScrollSearchBH (BHR.GetScroll "1m") search
+    let search = (BH.mkSearch query Nothing) {BH.size = BH.Size 5000, BH.sortBody = Just [docOrder]}
+    doScrollSearchBH (BHR.GetScroll "1m") (modifySearch search)
   go (getHits resp) (BH.scrollId resp)
  where
   -- no more result, stop here
@@ -113,6 +141,9 @@ scanSearch = do
   -- helper to get the hits of a search result
   getHits = BH.hits . BH.searchHits
 
+  -- the scroll order does not matter, sorting on _doc is the most efficient
+  docOrder = BH.DefaultSortSpec $ BH.DefaultSort (BH.FieldName "_doc") BH.Ascending Nothing Nothing Nothing Nothing
+
 -- | scan search the hit body, see the 'concat' doc for why we don't need catMaybes
 -- https://hackage.haskell.org/package/streaming-0.2.3.0/docs/Streaming-Prelude.html#v:concat
 scanSearchHit :: QEffects es => FromJSONField resp => Stream (Of resp) (Eff es) ()
@@ -127,7 +158,9 @@ scanSearchId = Streaming.map BH.hitDocId anyScan
  where
   -- here we need to help ghc figures out what fromJSON to use
   anyScan :: Stream (Of (BH.Hit AnyJSON)) (Eff es) ()
-  anyScan = scanSearch
+  anyScan = scanSearchWith noSource
+  -- only the ids are needed, there is no need to transfer the documents
+  noSource search = search {BH.source = Just BH.NoSource}
 
 scanSearchSimple :: QEffects es => FromJSONField resp => Eff es [resp]
 scanSearchSimple = Streaming.toList_ scanSearchHit
@@ -158,21 +191,13 @@ doSearch orderM limit = do
     SearchPB.Order_DirectionASC -> BH.Ascending
     SearchPB.Order_DirectionDESC -> BH.Descending
 
--- | Get search results hits, as fast as possible
-doFastSearch :: QEffects es => Word32 -> Eff es [Json.Value]
-doFastSearch limit = do
-  query <- getQueryBH
-  doSearchHitBH
-    (BH.mkSearch query Nothing)
-      { BH.size = BH.Size $ fromInteger $ toInteger $ max 50 limit
-      }
-
 -- | Get document count matching the query
 countDocs :: QEffects es => Eff es Count
-countDocs = do
-  query <-
-    fromMaybe (error "Need a query to count") <$> getQueryBH
-  doCountBH query
+countDocs = doCountBH =<< getCountQuery
+
+-- | Get the query to count documents
+getCountQuery :: QEffects es => Eff es BH.Query
+getCountQuery = fromMaybe (error "Need a query to count") <$> getQueryBH
 
 -- | Delete documents matching the query
 deleteDocs :: QEffects es => Eff es ()
@@ -183,7 +208,10 @@ deleteDocs = do
 
 -- | Get aggregation results
 doAggregation :: QEffects es => ToJSON body => body -> Eff es BH.AggregationResults
-doAggregation body = toAggRes <$> doSearchBH body
+doAggregation body = do
+  measureQueryM body do
+    index <- getIndexName
+    esAggregation index body
 
 toAggRes :: BH.SearchResult Value -> BH.AggregationResults
 toAggRes res = fromMaybe (error "oops") (BH.aggregations res)
@@ -279,20 +307,52 @@ getRatio = \case
   CHANGES_VS_REVIEWS_RATIO -> changesReviewsRatio
   COMMITS_VS_REVIEWS_RATIO -> commitsReviewsRatio
 
+-- | The doc count of the ratio filters aggregation buckets
+data RatioBuckets = RatioBuckets {rbEvents :: Word32, rbReviews :: Word32}
+
+instance FromJSON RatioBuckets where
+  parseJSON = Aeson.withObject "RatioBuckets" \v -> do
+    buckets <- v .: "buckets"
+    RatioBuckets <$> docCount buckets "events" <*> docCount buckets "reviews"
+   where
+    docCount buckets name = do
+      bucket <- buckets .: name
+      bucket .: "doc_count"
+
 -- | The base review ratio
 baseReviewsRatio :: QEffects es => [EDocType] -> Eff es Float
 baseReviewsRatio events = withFlavor qf do
-  count <- withFilter [documentTypes $ fromList events] countDocs
-  reviewCount <-
-    withFilter
-      [documentTypes $ fromList [EChangeReviewedEvent, EChangeCommentedEvent]]
-      countDocs
+  -- Both counts are computed with a single filters aggregation
+  RatioBuckets {..} <- withFilter [documentTypes $ fromList (events <> reviews)] do
+    queryBH <- getQueryBH
+    let agg =
+          Aeson.object
+            [ "agg1"
+                .= Aeson.object
+                  [ "filters"
+                      .= Aeson.object
+                        [ "filters"
+                            .= Aeson.object
+                              [ "events" .= documentTypes (fromList events)
+                              , "reviews" .= documentTypes (fromList reviews)
+                              ]
+                        ]
+                  ]
+            ]
+        search =
+          Aeson.object
+            [ "aggregations" .= agg
+            , "size" .= (0 :: Word)
+            , "query" .= fromMaybe (error "need query") queryBH
+            ]
+    queryAggResult search
   let total, countF, reviewCountF :: Float
       total = reviewCountF + countF
-      reviewCountF = fromIntegral reviewCount
-      countF = fromIntegral count
+      reviewCountF = fromIntegral rbReviews
+      countF = fromIntegral rbEvents
   pure (if total > 0 then reviewCountF * 100 / total else -1)
  where
+  reviews = [EChangeReviewedEvent, EChangeCommentedEvent]
   -- Author makes query author match the change event author, not the receiver of the event.
   -- CreatedAt is necessary for change event.
   qf = QueryFlavor Author CreatedAt
@@ -332,7 +392,10 @@ changeState state' =
 
 -- | Add a document type filter to the query
 documentTypes :: NonEmpty EDocType -> BH.Query
-documentTypes doc = BH.TermsQuery "type" $ from <$> doc
+documentTypes = \case
+  -- a single value is better served by a term query
+  doc :| [] -> mkTerm "type" (from doc)
+  docs -> BH.TermsQuery "type" $ from <$> docs
 
 documentType :: EDocType -> BH.Query
 documentType x = documentTypes (x :| [])
@@ -356,25 +419,14 @@ data EventCounts = EventCounts
   }
   deriving (Eq, Show)
 
--- | Author histo
-data HistoAuthorBucket = HistoAuthorBucket
-  { habKey :: LText
-  , habCount :: Word32
-  }
-  deriving (Eq, Show)
-
-instance FromJSON HistoAuthorBucket where
-  parseJSON (Object v) =
-    HistoAuthorBucket <$> v .: "key" <*> v .: "doc_count"
-  parseJSON _ = mzero
-
+-- | Author histo, the count of unique authors of a bucket
 newtype HistoAuthors = HistoAuthors
-  { haBuckets :: V.Vector HistoAuthorBucket
+  { haCount :: Word32
   }
   deriving (Eq, Show)
 
 instance FromJSON HistoAuthors where
-  parseJSON (Object v) = HistoAuthors <$> v .: "buckets"
+  parseJSON (Object v) = HistoAuthors <$> v .: "value"
   parseJSON _ = mzero
 
 instance BucketName HistoAuthors where
@@ -444,20 +496,23 @@ data FirstEvent = FirstEvent
   }
   deriving (Show)
 
-data JsonChangeEvent = JsonChangeEvent
-  { jceCreatedAt :: UTCTime
-  , jceOnCreatedAt :: UTCTime
-  , jceChangeId :: Json.ShortText
-  , jceAuthor :: Json.ShortText
-  }
+-- | The first event of each change, decoded from the 'firstEventOnChanges' aggregation
+newtype FirstEventBuckets = FirstEventBuckets {unFirstEventBuckets :: [FirstEvent]}
 
-decodeJsonChangeEvent :: Json.Value -> Maybe JsonChangeEvent
-decodeJsonChangeEvent v = do
-  jceCreatedAt <- Json.getDate =<< Json.getAttr "created_at" v
-  jceOnCreatedAt <- Json.getDate =<< Json.getAttr "on_created_at" v
-  jceChangeId <- Json.getString =<< Json.getAttr "change_id" v
-  jceAuthor <- Json.getString =<< Json.getAttr "muid" =<< Json.getAttr "author" v
-  pure $ JsonChangeEvent {..}
+instance FromJSON FirstEventBuckets where
+  parseJSON (Object v) = FirstEventBuckets <$> (traverse parseBucket =<< v .: "buckets")
+   where
+    parseBucket = Aeson.withObject "FirstEventBucket" \bucket -> do
+      hits <- (.: "hits") =<< (.: "hits") =<< bucket .: "first"
+      case hits of
+        [hit] -> parseFirstEvent =<< hit .: "_source"
+        _ -> fail "Expected a single hit"
+    parseFirstEvent = Aeson.withObject "FirstEvent" \source -> do
+      feChangeCreatedAt <- source .: "on_created_at"
+      feCreatedAt <- source .: "created_at"
+      feAuthor <- (.: "muid") =<< source .: "author"
+      pure FirstEvent {..}
+  parseJSON _ = mzero
 
 firstEventDuration :: FirstEvent -> Pico
 firstEventDuration FirstEvent {..} = elapsedSeconds feChangeCreatedAt feCreatedAt
@@ -469,43 +524,33 @@ firstEventOnChanges :: QEffects es => Eff es [FirstEvent]
 firstEventOnChanges = do
   (minDate, _) <- getQueryBound
 
-  -- Collect all the events
-  resultJson <- doFastSearch 10000
-  let result = mapMaybe decodeJsonChangeEvent resultJson
-
-  -- Group by change_id
-  let changeMap :: [NonEmpty JsonChangeEvent]
-      changeMap = HM.elems $ groupBy jceChangeId result
+  -- Get the first event of each change, elastic only returns one document per change
+  queryBH <- getQueryBH
+  let search =
+        Aeson.object
+          [ "aggregations" .= Aeson.object ["agg1" .= agg]
+          , "size" .= (0 :: Word)
+          , "query" .= fromMaybe (error "need query") queryBH
+          ]
+  result <- unFirstEventBuckets <$> queryAggResult search
 
   -- Remove old change where we may not have the first event
-  let keepRecent :: NonEmpty JsonChangeEvent -> Bool
-      keepRecent (JsonChangeEvent {..} :| _)
-        | jceOnCreatedAt > minDate = True
-        | otherwise = False
+  let keepRecent :: FirstEvent -> Bool
+      keepRecent FirstEvent {..} = feChangeCreatedAt > minDate
 
-  now <- unsafeEff_ getCurrentTime
-
-  -- For each change, get the detail of the first event
-  pure $ foldr toFirstEvent (initEvent now) <$> filter keepRecent changeMap
+  pure $ filter keepRecent result
  where
-  initEvent :: UTCTime -> FirstEvent
-  initEvent now =
-    let feChangeCreatedAt = now
-        feCreatedAt = now
-        feAuthor = ""
-     in FirstEvent {..}
-  toFirstEvent :: JsonChangeEvent -> FirstEvent -> FirstEvent
-  toFirstEvent JsonChangeEvent {..} acc =
-    let (createdAt, author) =
-          -- If the event is older update the info
-          if jceCreatedAt < feCreatedAt acc
-            then (jceCreatedAt, from $ Json.toText jceAuthor)
-            else (feCreatedAt acc, feAuthor acc)
-     in FirstEvent
-          { feChangeCreatedAt = jceOnCreatedAt
-          , feCreatedAt = createdAt
-          , feAuthor = author
-          }
+  agg =
+    Aeson.object
+      [ "terms" .= Aeson.object ["field" .= ("change_id" :: Text), "size" .= (10000 :: Word)]
+      , "aggs" .= Aeson.object ["first" .= Aeson.object ["top_hits" .= firstHit]]
+      ]
+  firstHit =
+    Aeson.object
+      [ "size" .= (1 :: Word)
+      , "sort" .= [Aeson.object ["created_at" .= Aeson.object ["order" .= ("asc" :: Text)]]]
+      , "_source" .= (["created_at", "on_created_at", "author.muid"] :: [Text])
+      ]
 
 -- | The achievement query
 data ProjectBucket = ProjectBucket
@@ -586,21 +631,24 @@ getTermKey :: BH.TermsResult -> Text
 getTermKey (BH.TermsResult (BH.TextValue tv) _ _) = tv
 getTermKey BH.TermsResult {} = error "Unexpected match"
 
-getTermsAgg :: QEffects es => Maybe BH.Query -> Text -> Maybe Int -> Eff es TermsResultWTH
-getTermsAgg query onTerm maxBuckets = do
-  search <- aggSearch query aggs
-  pure
-    $ TermsResultWTH
-      (getSimpleTR <$> filter isNotEmptyTerm (unfilteredR $ agResults search))
-      (agTH search)
+-- | Run a terms aggregation for each field using a single search request
+getTermsAggs :: (QEffects es, Traversable t) => Maybe BH.Query -> t Text -> Maybe Int -> Eff es (t TermsResultWTH)
+getTermsAggs query onTerms maxBuckets = do
+  search <- aggSearch query (foldMap mkAgg onTerms)
+  pure $ toTermsResult search <$> onTerms
  where
-  aggs =
-    BH.mkAggregations "singleTermAgg"
+  -- The aggregations are named after their field
+  mkAgg onTerm =
+    BH.mkAggregations (from onTerm)
       $ BH.TermsAgg
       $ (BH.mkTermsAggregation onTerm)
         { BH.termSize = maxBuckets
         }
-  unfilteredR search' = maybe [] BH.buckets (BH.toTerms "singleTermAgg" search')
+  toTermsResult search onTerm =
+    TermsResultWTH
+      (getSimpleTR <$> filter isNotEmptyTerm (unfilteredR onTerm $ agResults search))
+      (agTH search)
+  unfilteredR onTerm search' = maybe [] BH.buckets (BH.toTerms (from onTerm) search')
   -- Terms agg returns empty terms in a buckets
   isNotEmptyTerm :: BH.TermsResult -> Bool
   isNotEmptyTerm tr = getTermKey tr /= ""
@@ -629,26 +677,27 @@ countOnAuthors = cntAuthors "on_author.muid"
 cntAuthors :: QEffects es => Text -> Eff es Count
 cntAuthors = runCount
  where
-  runCount fn = getCardinalityAgg (BH.FieldName fn) maxCount
-  maxCount = Just 3000
+  runCount fn = getCardinalityAgg (BH.FieldName fn) (Just authorsPrecisionThreshold)
+
+-- | The cardinality precision used to count the authors, counts below this value are exact
+authorsPrecisionThreshold :: Int
+authorsPrecisionThreshold = 3000
 
 getDocTypeTopCountByField :: QEffects es => NonEmpty EDocType -> Text -> Maybe Word32 -> Eff es TermsResultWTH
-getDocTypeTopCountByField doctype attr size = withFilter [documentTypes doctype] do
+getDocTypeTopCountByField doctype attr size = runIdentity <$> getDocTypeTopCountByFields doctype (Identity attr) size
+
+getDocTypeTopCountByFields :: (QEffects es, Traversable t) => NonEmpty EDocType -> t Text -> Maybe Word32 -> Eff es (t TermsResultWTH)
+getDocTypeTopCountByFields doctype attrs size = withFilter [documentTypes doctype] do
   -- Prepare the query
   query <- getQueryBH
   runTermAgg query $ getSize size
  where
-  runTermAgg query = getTermsAgg query attr
+  runTermAgg query = getTermsAggs query attrs
   getSize size' = toInt <$> size'
   toInt int =
     let i' = fromInteger $ toInteger int
      in if i' <= 0 then 10 else i'
 
-openChangesCount :: QEffects es => Eff es Count
-openChangesCount = withFilter (changeState EChangeOpen) (withoutDate countDocs)
- where
-  withoutDate = withModified Q.dropDate
-
 -- | The repos_summary query
 getRepos :: QEffects es => Eff es TermsResultWTH
 getRepos =
@@ -665,31 +714,54 @@ data RepoSummary = RepoSummary
   }
   deriving (Show, Eq)
 
+-- | The repository summary counts, used to prepare and run the count queries together
+data RepoCounts a = RepoCounts
+  { rcCreated :: a
+  , rcUpdated :: a
+  , rcMerged :: a
+  , rcOpen :: a
+  , rcAbandoned :: a
+  }
+  deriving (Functor, Foldable, Traversable)
+
 getReposSummary :: QEffects es => Eff es [RepoSummary]
 getReposSummary = do
   repos <- getRepos
   let names = trTerm <$> tsrTR repos
-  traverse getRepoSummary names
+  -- The count queries are prepared once, only the repository filter changes between repos
+  queries <- withoutRepoFilters (sequenceA summaryQueries)
+  traverse (getRepoSummary queries) names
  where
   withoutRepoFilters =
     -- Remove the initial repo filter to speedup the summary query.
     -- It is not necessary to keep such filter as we already got the repos list.
     -- This is important for project with huge list of repository regex.
     withModified (Q.dropField (`elem` ["repo", "project"]))
-  withRepo fn = withoutRepoFilters . withFilter [mkTerm "repository_fullname" fn]
-
-  getRepoSummary fullname = withRepo fullname do
-    -- Prepare the queries
-    let changeQF = withFlavor (QueryFlavor Author UpdatedAt)
-
-    -- Count the events
-    createdChanges <- wordToCount <$> runMetricNum metricChangesCreated
-    updatedChanges <- withFilter (changeState EChangeOpen) (changeQF countDocs)
-    mergedChanges <- wordToCount <$> runMetricNum metricChangesMerged
-    openChanges <- openChangesCount
-    abandonedChanges <- wordToCount <$> runMetricNum metricChangesAbandoned
+  withRepo fn query = mkAnd [mkTerm "repository_fullname" fn, query]
+
+  changeQF = withFlavor (QueryFlavor Author UpdatedAt)
+  eventQuery dt = withFilter [documentType dt] (withFlavor changeEventFlavor getCountQuery)
+  summaryQueries =
+    RepoCounts
+      { rcCreated = eventQuery EChangeCreatedEvent
+      , rcUpdated = withFilter (changeState EChangeOpen) (changeQF getCountQuery)
+      , rcMerged = eventQuery EChangeMergedEvent
+      , rcOpen = withFilter (changeState EChangeOpen) (withModified Q.dropDate getCountQuery)
+      , rcAbandoned = eventQuery EChangeAbandonedEvent
+      }
 
-    pure $ RepoSummary {..}
+  getRepoSummary queries fullname = do
+    -- Count the events using a single request
+    RepoCounts {..} <- doMultiCountBH (withRepo fullname <$> queries)
+    pure
+      $ RepoSummary
+        { fullname
+        , createdChanges = rcCreated
+        , abandonedChanges = rcAbandoned
+        , mergedChanges = rcMerged
+        , updatedChanges = rcUpdated
+        , openChanges = rcOpen
+        }
 
 getChangeEventsTop :: QEffects es => Word32 -> NonEmpty EDocType -> Text -> QueryFlavor -> Eff es TermsResultWTH
 getChangeEventsTop limit docs qfield qf =
@@ -723,6 +795,7 @@ getAuthorsPeersStrength = \case
 
 getAndSortToPeerStrength :: Int -> [(Text, [TermResult])] -> [PeerStrengthResult]
 getAndSortToPeerStrength limit authors_peers =
+  -- The sort is lazy, taking the first results does not sort the whole list
   take (fromInteger $ toInteger limit)
     $ sortBy
       (comparing Data.Ord.Down)
@@ -741,6 +814,73 @@ getAndSortToPeerStrength limit authors_peers =
      in
       toPSR <$> peers_authors
 
+-- | A terms aggregation bucket with the buckets of its "peers" terms sub aggregation
+data PeersBucket = PeersBucket
+  { pebAuthor :: Text
+  , pebPeers :: [TermResult]
+  }
+  deriving (Show, Eq)
+
+instance FromJSON PeersBucket where
+  parseJSON (Object v) = PeersBucket <$> v .: "key" <*> (traverse parseTerm =<< (.: "buckets") =<< v .: "peers")
+   where
+    parseTerm = Aeson.withObject "TermResult" \bucket -> TermResult <$> bucket .: "key" <*> bucket .: "doc_count"
+  parseJSON _ = mzero
+
+newtype PeersBuckets = PeersBuckets {unPeersBuckets :: [PeersBucket]}
+
+instance FromJSON PeersBuckets where
+  parseJSON (Object v) = PeersBuckets <$> v .: "buckets"
+  parseJSON _ = mzero
+
+-- | Get the peers of the top authors using a single nested terms aggregation
+getPeersAgg :: QEffects es => Text -> Int -> Text -> Int -> Eff es [(Text, [TermResult])]
+getPeersAgg onTerm size peerTerm peersSize = do
+  query <- getQueryBH
+  buckets <- unPeersBuckets <$> queryAggResult (BHR.mkAgg [("agg1", agg)] Nothing query)
+  pure $ toPeers <$> filter ((/= "") . pebAuthor) buckets
+ where
+  agg =
+    Aeson.object
+      [ "terms" .= Aeson.object ["field" .= onTerm, "size" .= size]
+      , "aggs"
+          .= Aeson.object
+            [ "peers" .= Aeson.object ["terms" .= Aeson.object ["field" .= peerTerm, "size" .= peersSize]]
+            ]
+      ]
+  -- Terms agg returns empty terms in a buckets
+  toPeers PeersBucket {..} = (pebAuthor, filter ((/= "") . trTerm) pebPeers)
+
+-- | Run 'getPeersAgg' for the given authors, using as many requests as needed to
+-- keep the amount of buckets of each request below 'peersBucketsBudget'.
+getPeersAggFor :: QEffects es => Text -> NonEmpty Text -> Text -> Int -> Eff es [(Text, [TermResult])]
+getPeersAggFor onTerm names peerTerm peersSize =
+  concat <$> traverse runChunk (mapMaybe nonEmpty $ chunksOf chunkSize (toList names))
+ where
+  chunkSize = max 1 (peersBucketsBudget `div` (peersSize + 1))
+  runChunk chunk =
+    withFilter [BH.TermsQuery onTerm chunk]
+      $ getPeersAgg onTerm (length chunk) peerTerm peersSize
+  chunksOf n xs = case splitAt n xs of
+    (chunk, []) -> [chunk]
+    (chunk, rest) -> chunk : chunksOf n rest
+
+-- | The maximum amount of buckets (authors and their peers) requested by a single peers aggregation,
+-- this is well below the elastic 'search.max_buckets' default setting (65536).
+peersBucketsBudget :: Int
+peersBucketsBudget = 10000
+
+-- | The amount of buckets to get when the limit is not set
+peersTopSize :: Word32 -> Int
+peersTopSize limit
+  | limit == 0 = 10
+  | otherwise = fromInteger $ toInteger limit
+
+-- | The amount of peers to get for each author. Only the top 'limit' results are returned,
+-- thus an author can not contribute more than 'limit' peers, plus one for its own (filtered) entry.
+peersSubSize :: Word32 -> Int
+peersSubSize limit = peersTopSize limit + 1
+
 -- | This function is used by the API peersStrength metrics (QUERY_TOP_AUTHORS_PEERS)
 getAuthorsPeersStrengthFromChangeAuthors :: QEffects es => Word32 -> Eff es [PeerStrengthResult]
 getAuthorsPeersStrengthFromChangeAuthors limit = withFlavor qf do
@@ -752,46 +892,43 @@ getAuthorsPeersStrengthFromChangeAuthors limit = withFlavor qf do
       (fromList [EChangeDoc])
       "author.muid"
       (Just limit)
-  -- We filter events (only reviews and comments) performed on changes created by each of those authors
-  -- and we extract the list of event' authors sorted by the amount of produced events
+  -- We filter events (only reviews and comments) performed on changes created by those authors
+  -- and we extract, for each of them, the list of event' authors sorted by the amount of produced events
   -- authors_peers is a list of tuple [(change author, [peer reviewers])]
-  authors_peers <- traverse (getAuthorPeers . trTerm) (tsrTR authors)
+  authors_peers <- case nonEmpty (trTerm <$> tsrTR authors) of
+    Nothing -> pure []
+    Just names ->
+      withFilter [documentTypes eventTypes]
+        $ withModified Q.dropAuthor
+        $ getPeersAggFor "on_author.muid" names "author.muid" (peersSubSize limit)
   -- We transform the data to the PeerStrengthResult data type
   pure $ getAndSortToPeerStrength (fromInteger $ toInteger limit) authors_peers
  where
+  eventTypes :: NonEmpty EDocType
+  eventTypes = fromList [EChangeReviewedEvent, EChangeCommentedEvent]
   qf = QueryFlavor Author CreatedAt
-  getAuthorPeers :: QEffects es => Text -> Eff es (Text, [TermResult])
-  getAuthorPeers author = withFilter [mkTerm "on_author.muid" author] $ withModified Q.dropAuthor $ do
-    event_authors <-
-      getDocTypeTopCountByField
-        (fromList [EChangeReviewedEvent, EChangeCommentedEvent])
-        "author.muid"
-        (Just 5000)
-    pure (author, tsrTR event_authors)
 
 -- | This function is similar to getAuthorsPeersStrengthFromChangeAuthors except that the filtering
 -- | of authors based on the query is done on event documents.
 getAuthorsPeersStrengthFromPeerReviewers :: QEffects es => Word32 -> Eff es [PeerStrengthResult]
 getAuthorsPeersStrengthFromPeerReviewers limit = withFlavor qf do
-  event_authors <-
-    getDocTypeTopCountByField
-      eventTypes
-      "author.muid"
-      (Just limit)
-  authors <- traverse (getAuthorPeers . trTerm) (tsrTR event_authors)
+  -- For each of the top event' authors, get the change' authors on which they did a comment/review
+  authors <- withFilter [documentTypes eventTypes] do
+    if size * (peersSize + 1) <= peersBucketsBudget
+      then getPeersAgg "author.muid" size "on_author.muid" peersSize
+      else do
+        -- Too many buckets for a single request, get the top event' authors first
+        topAuthors <- getDocTypeTopCountByField eventTypes "author.muid" (Just limit)
+        case nonEmpty (trTerm <$> tsrTR topAuthors) of
+          Nothing -> pure []
+          Just names -> getPeersAggFor "author.muid" names "on_author.muid" peersSize
   pure $ getAndSortToPeerStrength (fromInteger $ toInteger limit) authors
  where
+  size = peersTopSize limit
+  peersSize = peersSubSize limit
   eventTypes :: NonEmpty EDocType
   eventTypes = fromList [EChangeReviewedEvent, EChangeCommentedEvent]
   qf = QueryFlavor Author CreatedAt
-  getAuthorPeers :: QEffects es => Text -> Eff es (Text, [TermResult])
-  getAuthorPeers event_author = withFilter [mkTerm "author.muid" event_author] do
-    change_authors <-
-      getDocTypeTopCountByField
-        eventTypes
-        "on_author.muid"
-        (Just 5000)
-    pure (event_author, tsrTR change_authors)
 
 -- | Convert a duration to an interval that spans over maximum 24 buckets (31 for days)
 newtype TimeFormat = TimeFormat {getFormat :: Text}
@@ -814,6 +951,29 @@ dateInterval hi = formatTime' formatStr
     Q.Month -> "%Y-%m"
     Q.Year -> "%Y"
 
+-- | The date_histogram aggregation settings for the bounds and interval
+dateHistogram :: Maybe Text -> UTCTime -> UTCTime -> Q.TimeRange -> Value
+dateHistogram field minDate maxDate interval =
+  Aeson.object
+    [ "field" .= field
+    , histoInterval
+    , "format" .= getFormat (from interval)
+    , -- Empty buckets are kept so that the histogram covers the whole bounds
+      "min_doc_count" .= (0 :: Word)
+    , "extended_bounds" .= bound
+    ]
+ where
+  -- Fixed intervals are cheaper to compute than calendar ones, use them when they are equivalent in UTC
+  histoInterval = case interval of
+    Q.Hour -> "fixed_interval" .= ("1h" :: Text)
+    Q.Day -> "fixed_interval" .= ("1d" :: Text)
+    _ -> "calendar_interval" .= into @Text interval
+  bound =
+    Aeson.object
+      [ "min" .= dateInterval interval minDate
+      , "max" .= dateInterval interval maxDate
+      ]
+
 getNewContributors :: QEffects es => Eff es [TermResult]
 getNewContributors = do
   -- Get query min bound
@@ -838,48 +998,58 @@ getNewContributors = do
   afterAuthor <- withModified Q.dropDate (withFilter [afterBounceQ minDate] runQ)
 
   -- Only keep after authors not present in the before authors list
-  let ba = trTerm <$> tsrTR beforeAuthor
-  pure $ filter (\tr -> trTerm tr `notElem` ba) (tsrTR afterAuthor)
+  let ba = Set.fromList $ trTerm <$> tsrTR beforeAuthor
+  pure $ filter (\tr -> trTerm tr `Set.notMember` ba) (tsrTR afterAuthor)
 
 -- | getChangesTop
 getChangesTop :: QEffects es => Word32 -> Text -> Eff es TermsResultWTH
-getChangesTop limit attr =
+getChangesTop limit attr = runIdentity <$> getChangesTopFields limit (Identity attr)
+
+getChangesTopFields :: (QEffects es, Traversable t) => Word32 -> t Text -> Eff es (t TermsResultWTH)
+getChangesTopFields limit attrs =
   withFlavor (QueryFlavor Author CreatedAt)
-    $ getDocTypeTopCountByField
+    $ getDocTypeTopCountByFields
       (EChangeDoc :| [])
-      attr
+      attrs
       -- Ask for a large amount of buckets to hopefully
       -- get a total count that is accurate
       (Just limit)
 
-getChangesTopRepos :: QEffects es => Word32 -> Eff es TermsResultWTH
-getChangesTopRepos limit = getChangesTop limit "repository_fullname"
-
-getChangesTopApprovals :: QEffects es => Word32 -> Eff es TermsResultWTH
-getChangesTopApprovals limit = getChangesTop limit "approval"
+-- | The changes tops fields, used to run the tops aggregations together
+data ChangesTopsFields a = ChangesTopsFields
+  { ctAuthors :: a
+  , ctRepos :: a
+  , ctApprovals :: a
+  }
+  deriving (Functor, Foldable, Traversable)
 
 getChangesTops :: QEffects es => Word32 -> Eff es SearchPB.ChangesTops
 getChangesTops limit = do
-  authors <- runMetricTop metricChangeAuthors limit
-  repos <- getChangesTopRepos limit
-  approvals <- getChangesTopApprovals limit
+  -- The tops share the same query, they are computed with a single search request
+  ChangesTopsFields {..} <- getChangesTopFields limit fields
   let result =
-        let changesTopsAuthors = toTermsCountPBInt <$> authors
-            changesTopsRepos = toTermsCount (toInt $ tsrTH repos) (tsrTR repos)
-            changesTopsApprovals = toTermsCount (toInt $ tsrTH approvals) (tsrTR approvals)
+        let changesTopsAuthors = toTermsCount ctAuthors
+            changesTopsRepos = toTermsCount ctRepos
+            changesTopsApprovals = toTermsCount ctApprovals
          in SearchPB.ChangesTops {..}
   pure result
  where
+  fields =
+    ChangesTopsFields
+      { ctAuthors = "author.muid"
+      , ctRepos = "repository_fullname"
+      , ctApprovals = "approval"
+      }
   toPBTermCount TermResult {..} =
     MetricPB.TermCountInt
       (from trTerm)
       (toInt trCount)
   toInt c = fromInteger $ toInteger c
-  toTermsCount total tsc =
+  toTermsCount TermsResultWTH {..} =
     Just
       $ MetricPB.TermsCountInt
-        { termsCountIntTermcount = V.fromList $ toPBTermCount <$> tsc
-        , termsCountIntTotalHits = total
+        { termsCountIntTermcount = V.fromList $ toPBTermCount <$> tsrTR
+        , termsCountIntTotalHits = toInt tsrTH
         }
 
 searchBody :: QEffects es => QueryFlavor -> Value -> Eff es Value
@@ -919,9 +1089,7 @@ changeMergedAvgCommits qf = queryAggValue =<< searchBody qf avg
 
 withDocTypes :: QEffects es => [EDocType] -> QueryFlavor -> Eff es a -> Eff es a
 withDocTypes docTypes flavor qm =
-  withFilter [mkOr $ toTermQuery <$> docTypes] $ withFlavor flavor qm
- where
-  toTermQuery docType = mkTerm "type" (from docType)
+  withFilter (documentTypes <$> maybeToList (nonEmpty docTypes)) $ withFlavor flavor qm
 
 withDocType :: QEffects es => EDocType -> QueryFlavor -> Eff es a -> Eff es a
 withDocType docType = withDocTypes [docType]
@@ -1232,19 +1400,7 @@ countHisto rf intervalM = fmap toHisto <$> getCountHisto
     queryBH <- getQueryBH
     (minDate, maxDate, interval) <- queryToHistoBounds intervalM
 
-    let bound =
-          Aeson.object
-            [ "min" .= dateInterval interval minDate
-            , "max" .= dateInterval interval maxDate
-            ]
-        date_histo =
-          Aeson.object
-            [ "field" .= rangeField rf
-            , "calendar_interval" .= into @Text interval
-            , "format" .= getFormat (from interval)
-            , "min_doc_count" .= (0 :: Word)
-            , "extended_bounds" .= bound
-            ]
+    let date_histo = dateHistogram (rangeField rf) minDate maxDate interval
         agg =
           Aeson.object
             [ "agg1" .= Aeson.object ["date_histogram" .= date_histo]
@@ -1271,40 +1427,23 @@ authorCntHisto aField changeEvent intervalM = withDocType changeEvent qf getAuth
   getAuthorHistoPB = fmap toHisto <$> getAuthorCountHisto
   toHisto HistoBucket {..} =
     let hDate = from hbDate
-        hValue =
-          fromInteger
-            . toInteger
-            . length
-            . haBuckets
-            . fromMaybe (error "subbucket not found")
-            $ hbSubBuckets
+        hValue = haCount . fromMaybe (error "subbucket not found") $ hbSubBuckets
      in Histo {..}
   getAuthorCountHisto :: Eff es (V.Vector (HistoBucket HistoAuthors))
   getAuthorCountHisto = do
     queryBH <- getQueryBH
     (minDate, maxDate, interval) <- queryToHistoBounds intervalM
 
-    let bound =
-          Aeson.object
-            [ "min" .= dateInterval interval minDate
-            , "max" .= dateInterval interval maxDate
-            ]
-        date_histo =
-          Aeson.object
-            [ "field" .= rangeField (qfRange qf)
-            , "calendar_interval" .= into @Text interval
-            , "format" .= getFormat (from interval)
-            , "min_doc_count" .= (0 :: Word)
-            , "extended_bounds" .= bound
-            ]
+    let date_histo = dateHistogram (rangeField (qfRange qf)) minDate maxDate interval
+        -- Only the count of unique authors is needed, there is no need to fetch the authors buckets
         author_agg =
           Aeson.object
             [ "authors"
                 .= Aeson.object
-                  [ "terms"
+                  [ "cardinality"
                       .= Aeson.object
                         [ "field" .= aField
-                        , "size" .= (10000 :: Word)
+                        , "precision_threshold" .= authorsPrecisionThreshold
                         ]
                   ]
             ]
@@ -1353,12 +1492,14 @@ changeEventCount :: QEffects es => MetricInfo -> EDocType -> Metric es Word32
 changeEventCount mi dt =
   Metric mi (Num . countToWord <$> compute) computeTrend topNotSupported
  where
-  compute = withFilter [documentType dt] (withFlavor qf countDocs)
-  computeTrend interval = withDocType dt qf $ countHisto CreatedAt interval
-  qf = QueryFlavor OnAuthor CreatedAt
+  compute = withFilter [documentType dt] (withFlavor changeEventFlavor countDocs)
+  computeTrend interval = withDocType dt changeEventFlavor $ countHisto CreatedAt interval
+
+changeEventFlavor :: QueryFlavor
+changeEventFlavor = QueryFlavor OnAuthor CreatedAt
 
 changeEventFlavorDesc :: Text
-changeEventFlavorDesc = queryFlavorToDesc (QueryFlavor OnAuthor CreatedAt)
+changeEventFlavorDesc = queryFlavorToDesc changeEventFlavor
 
 metricChangesCreated :: QEffects es => Metric es Word32
 metricChangesCreated = changeEventCount mi EChangeCreatedEvent
@@ -941,6 +941,75 @@ testGetNewContributors = withTenant doTest
         [Q.TermResult {trTerm = "bob", trCount = 1}]
         results
 
+testFirstEventMeanTime :: Assertion
+testFirstEventMeanTime = withTenant doTest
+ where
+  -- An event on a change created at fakeDate, the event happens 'ts' seconds later
+  mkEvent' ts etype author cid =
+    (mkEvent ts fakeDate etype author eve cid "openstack/nova")
+      { echangeeventId = from etype <> "-" <> cid <> "-" <> authorMuid author
+      , echangeeventOnCreatedAt = fakeDate
+      }
+  firstEvents dt =
+    Q.withEvents [Q.documentType dt]
+      $ withFlavor (Q.QueryFlavor Q.Author Q.OnCreatedAt) Q.firstEventOnChanges
+  toAuthorDelay fe = (Q.feAuthor fe, Q.firstEventDuration fe)
+  doTest :: Eff [MonoQuery, ElasticEffect, LoggerEffect, IOE] ()
+  doTest = dieOnEsError do
+    I.indexChanges [mkChange 0 fakeDate eve cid "openstack/nova" EChangeOpen | cid <- ["42", "43"]]
+    I.indexEvents
+      [ mkEvent' 600 EChangeCommentedEvent alice "42"
+      , mkEvent' 1800 EChangeCommentedEvent bob "42"
+      , mkEvent' 3600 EChangeReviewedEvent bob "42"
+      , mkEvent' 7200 EChangeReviewedEvent alice "42"
+      , mkEvent' 2400 EChangeCommentedEvent alice "43"
+      , mkEvent' 1800 EChangeCommentedEvent bob "43"
+      , mkEvent' 1200 EChangeReviewedEvent alice "43"
+      ]
+
+    withQuery defaultQuery do
+      -- The first comment of each change is from alice after 600s and from bob after 1800s
+      comments <- sort . fmap toAuthorDelay <$> firstEvents EChangeCommentedEvent
+      assertEqual' "Check first comments" [("alice", 600), ("bob", 1800)] comments
+      Q.Duration commentDelay <- Q.runMetricNum Q.metricFirstCommentMeanTime
+      assertEqual' "Check first comment mean time" 1200 commentDelay
+
+      -- The first review of each change is from bob after 3600s and from alice after 1200s
+      reviews <- sort . fmap toAuthorDelay <$> firstEvents EChangeReviewedEvent
+      assertEqual' "Check first reviews" [("alice", 1200), ("bob", 3600)] reviews
+      Q.Duration reviewDelay <- Q.runMetricNum Q.metricFirstReviewMeanTime
+      assertEqual' "Check first review mean time" 2400 reviewDelay
+
+testGetRatio :: Assertion
+testGetRatio = withTenant doTest
+ where
+  doTest :: Eff [MonoQuery, ElasticEffect, LoggerEffect, IOE] ()
+  doTest = dieOnEsError do
+    withQuery defaultQuery do
+      -- Without events, the ratio is not defined
+      noChangesRatio <- Q.getRatio Q.CHANGES_VS_REVIEWS_RATIO
+      assertEqual' "Check changes ratio without data" (-1) noChangesRatio
+      noCommitsRatio <- Q.getRatio Q.COMMITS_VS_REVIEWS_RATIO
+      assertEqual' "Check commits ratio without data" (-1) noCommitsRatio
+
+    -- Index 2 changes with a review each, 3 commits and a comment
+    let nova = SProject "openstack/nova" [alice] [bob] [eve]
+    traverse_ (indexScenarioNO nova) ["42", "43"]
+    I.indexEvents
+      [ mkEvent 10 fakeDate EChangeCommitPushedEvent eve eve "42" "openstack/nova"
+      , mkEvent 20 fakeDate EChangeCommitPushedEvent eve eve "43" "openstack/nova"
+      , mkEvent 30 fakeDate EChangeCommitForcePushedEvent eve eve "43" "openstack/nova"
+      , mkEvent 40 fakeDate EChangeCommentedEvent bob eve "43" "openstack/nova"
+      ]
+
+    withQuery defaultQuery do
+      -- 3 reviews and comments for 2 created changes
+      changesRatio <- Q.getRatio Q.CHANGES_VS_REVIEWS_RATIO
+      assertEqual' "Check changes ratio" 60 changesRatio
+      -- 3 reviews and comments for 3 commits
+      commitsRatio <- Q.getRatio Q.COMMITS_VS_REVIEWS_RATIO
+      assertEqual' "Check commits ratio" 50 commitsRatio
+
 testLifecycleStats :: Assertion
 testLifecycleStats = withTenant doTest
  where
@@ -86,7 +86,6 @@ import Servant qualified
 import Data.Vector qualified as V
 import Database.Bloodhound qualified as BH
 import Database.Bloodhound.Raw qualified as BHR
-import Json.Extras qualified as Json
 
 -- for MonoQuery
 
@@ -440,6 +439,14 @@ esSearch iname body scrollReq = do
 esSearchByIndex :: (Error ElasticError :> es, ElasticEffect :> es, ToJSON body, FromJSONField resp) => BH.IndexName -> body -> Eff es [BH.Hit resp]
 esSearchByIndex iname body = BH.hits . BH.searchHits <$> esSearch iname body BHR.NoScroll
 
+esAggregation :: (Error ElasticError :> es, ElasticEffect :> es, ToJSON body) => BH.IndexName -> body -> Eff es BH.AggregationResults
+esAggregation iname body = do
+  runBHIOSafe "esAggregation" body $ BHR.aggregation iname body
+
+esMultiSearch :: (Error ElasticError :> es, ElasticEffect :> es, ToJSON body, FromJSON resp) => BH.IndexName -> [body] -> Eff es [resp]
+esMultiSearch iname bodies = do
+  runBHIOSafe "esMultiSearch" bodies $ BHR.msearch iname bodies
+
 esAdvance :: (Error ElasticError :> es, ElasticEffect :> es, FromJSON resp) => BH.ScrollId -> Eff es (BH.SearchResult resp)
 esAdvance scroll = do
   runBHIOSafe "esAdvance" scroll $ BHR.advance scroll
@@ -452,10 +459,6 @@ esCountByIndex :: (Error ElasticError :> es, ElasticEffect :> es) => BH.IndexNam
 esCountByIndex iname q = do
   runBHIOSafe "esCountByIndex" q $ BH.countByIndex iname q
 
-esSearchHit :: (Error ElasticError :> es, ElasticEffect :> es) => ToJSON body => BH.IndexName -> body -> Eff es [Json.Value]
-esSearchHit iname body = do
-  runBHIOSafe "esSearchHit" body $ BHR.searchHit iname body
-
 esScanSearch :: (Error ElasticError :> es, ElasticEffect :> es) => FromJSON body => BH.IndexName -> BH.Search -> Eff es [BH.Hit body]
 esScanSearch iname search = do
   runBHIOSafe "esScanSearch" search $ BH.scanSearch iname search
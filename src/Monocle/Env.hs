@@ -38,8 +38,12 @@ data QueryTarget
 -- | Create the bloodhound environment
 mkEnv :: MonadIO m => Text -> m BH.BHEnv
 mkEnv server = do
-  manager <- liftIO $ HTTP.newManager HTTP.defaultManagerSettings
+  manager <- liftIO $ HTTP.newManager settings
   pure $ BH.mkBHEnv (BH.Server server) manager
+ where
+  -- The environment is shared by all the api requests, keep enough open connections
+  -- so that concurrent queries do not wait for an available one.
+  settings = HTTP.defaultManagerSettings {HTTP.managerConnCount = 32}
 
 mkEnv' :: MonadIO m => m BH.BHEnv
 mkEnv' = do
@@ -73,10 +77,11 @@ mkQuery bhq =
       queryMinBoundsSet = False
    in Q.Query {..}
 
+-- | 'mkFinalQuery' combines the queries in a filter context.
+-- Filter clauses are not scored and elastic can cache them.
 mkFinalQuery :: Maybe Q.QueryFlavor -> Q.Query -> Maybe BH.Query
 mkFinalQuery flavorM query = toBoolQuery $ Q.queryGet query id flavorM
  where
   toBoolQuery = \case
     [] -> Nothing
-    [x] -> Just x
     xs -> Just $ BH.QueryBoolQuery $ BH.mkBoolQuery [] (BH.Filter <$> xs) [] []
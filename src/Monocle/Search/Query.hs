@@ -28,6 +28,7 @@ module Monocle.Search.Query (
 
 import Control.Monad.Trans.Except (Except, runExcept, throwE)
 import Data.List (lookup)
+import Data.Text qualified as Text
 import Data.Time.Calendar (addDays, addGregorianMonthsClip, addGregorianYearsClip)
 import Data.Time.Clock (UTCTime (UTCTime), secondsToNominalDiffTime)
 import Data.Time.Format (defaultTimeLocale, formatTime, parseTimeM)
@@ -344,16 +345,31 @@ toParseError e = case e of
   Left msg -> throwParseError msg
   Right x -> pure x
 
+-- | Create a regexp query, or a term query when the value is a literal.
+-- Term queries are much faster and they can be cached by elastic.
+--
+-- >>> encode $ mkRegexpQuery "repository_fullname" "zuul"
+-- "{\"term\":{\"repository_fullname\":{\"value\":\"zuul\"}}}"
+-- >>> encode $ mkRegexpQuery "repository_fullname" "zuul/.*"
+-- "{\"regexp\":{\"repository_fullname\":{\"flags\":\"ALL\",\"value\":\"zuul/.*\"}}}"
+mkRegexpQuery :: Field -> Text -> BH.Query
+mkRegexpQuery field value
+  | Text.any isRegexpOperator value =
+      BH.QueryRegexpQuery
+        $ BH.RegexpQuery (BH.FieldName field) (BH.Regexp value) BH.AllRegexpFlags Nothing
+  | otherwise = BH.TermQuery (BH.Term field value) Nothing
+ where
+  -- The reserved characters of the regexp syntax, including the optional operators enabled by the ALL flag
+  isRegexpOperator = (`elem` (".?+*|{}[]()\"\\#@&<>~" :: String))
+
 mkProjectQuery :: Config.Project -> BH.Query
 mkProjectQuery Config.Project {..} = BH.QueryBoolQuery $ BH.mkBoolQuery must [] [] []
  where
   must =
-    map BH.QueryRegexpQuery
-      $ maybe [] repository repository_regex
+    maybe [] repository repository_regex
       <> maybe [] branch branch_regex
       <> maybe [] file file_regex
-  mkRegexpQ field value =
-    [BH.RegexpQuery (BH.FieldName field) (BH.Regexp value) BH.AllRegexpFlags Nothing]
+  mkRegexpQ field value = [mkRegexpQuery field value]
   repository = mkRegexpQ "repository_fullname"
   branch = mkRegexpQ "target_branch"
   file = mkRegexpQ "changed_files.path"
@@ -403,10 +419,7 @@ mkEqQuery field value' = do
           `orDie` ("Unknown group: " <> value)
       pure $ BH.TermsQuery (from fieldName) groupMembers
     (_, Field_TypeFIELD_BOOL) -> toParseError $ flip BH.TermQuery Nothing . BH.Term (from fieldName) <$> parseBoolean value
-    (_, Field_TypeFIELD_REGEX) ->
-      pure
-        . BH.QueryRegexpQuery
-        $ BH.RegexpQuery (BH.FieldName fieldName) (BH.Regexp value) BH.AllRegexpFlags Nothing
+    (_, Field_TypeFIELD_REGEX) -> pure $ mkRegexpQuery fieldName value
     (_, Field_TypeFIELD_DATE) ->
       toParseError $ Left $ "Invalid date operator for: " <> field <> ", ':' is not allowed"
     _anyOtherField -> pure $ BH.TermQuery (BH.Term (from fieldName) value) Nothing
@@ -3,9 +3,8 @@
 -- common protobuf implementation.
 module Monocle.Servant.PBJSON (PBJSON) where
 
-import Data.Aeson.Encoding (fromEncoding)
-import Data.Binary.Builder (toLazyByteString)
-import Proto3.Suite.JSONPB (ToJSONPB, defaultOptions, optEmitNamedOneof, toEncodingPB)
+import Data.Aeson.Encoding (encodingToLazyByteString)
+import Proto3.Suite.JSONPB (Options, ToJSONPB, defaultOptions, optEmitNamedOneof, toEncodingPB)
 import Relude
 import Servant.API.ContentTypes (Accept (..), MimeRender (..))
 
@@ -16,4 +15,8 @@ instance Accept PBJSON where
   contentType _ = "application/json"
 
 instance ToJSONPB a => MimeRender PBJSON a where
-  mimeRender _ v = toLazyByteString $ fromEncoding $ toEncodingPB v (defaultOptions {optEmitNamedOneof = False})
+  mimeRender _ v = encodingToLazyByteString $ toEncodingPB v pbOptions
+
+-- | The encoding options, defined once instead of for every response
+pbOptions :: Options
+pbOptions = defaultOptions {optEmitNamedOneof = False}
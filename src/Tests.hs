@@ -259,6 +259,8 @@ monocleBackendQueriesTests =
     , testCase "Test top authors" testTopAuthors
     , testCase "Test changes top" testGetChangesTops
     , testCase "Test authors peers strength" testGetAuthorsPeersStrength
+    , testCase "Test first event mean time" testFirstEventMeanTime
+    , testCase "Test reviews ratio" testGetRatio
     , testCase "Test lifecycleStats" testLifecycleStats
     , testCase "Test newContributors" testGetNewContributors
     , testCase "Test getActivityStats" testGetActivityStats
@@ -402,6 +404,12 @@ monocleSearchLanguage =
             "repo:openstack/.*nova.*"
             "{\"regexp\":{\"repository_fullname\":{\"flags\":\"ALL\",\"value\":\"openstack/.*nova.*\"}}}"
         )
+    , testCase
+        "Query literal regex"
+        ( queryMatch
+            "repo:openstack/nova"
+            "{\"term\":{\"repository_fullname\":{\"value\":\"openstack/nova\"}}}"
+        )
     , testCase
         "Query state"
         ( queryMatch
@@ -467,21 +475,21 @@ monocleSearchLanguage =
         "Query project"
         ( queryMatch
             "project:zuul"
-            "{\"bool\":{\"must\":[{\"regexp\":{\"repository_fullname\":{\"flags\":\"ALL\",\"value\":\"zuul/.*\"}}},{\"regexp\":{\"target_branch\":{\"flags\":\"ALL\",\"value\":\"master\"}}},{\"regexp\":{\"changed_files.path\":{\"flags\":\"ALL\",\"value\":\"tests/.*\"}}}]}}"
+            "{\"bool\":{\"must\":[{\"regexp\":{\"repository_fullname\":{\"flags\":\"ALL\",\"value\":\"zuul/.*\"}}},{\"term\":{\"target_branch\":{\"value\":\"master\"}}},{\"regexp\":{\"changed_files.path\":{\"flags\":\"ALL\",\"value\":\"tests/.*\"}}}]}}"
         )
     , testCase
         "Query author"
         ( queryMatchFlavor
             (Q.QueryFlavor Q.Author Q.UpdatedAt)
             "author:alice"
-            "{\"regexp\":{\"author.muid\":{\"flags\":\"ALL\",\"value\":\"alice\"}}}"
+            "{\"term\":{\"author.muid\":{\"value\":\"alice\"}}}"
         )
     , testCase
         "Query on author"
         ( queryMatchFlavor
             (Q.QueryFlavor Q.OnAuthor Q.UpdatedAt)
             "author:alice"
-            "{\"regexp\":{\"on_author.muid\":{\"flags\":\"ALL\",\"value\":\"alice\"}}}"
+            "{\"term\":{\"on_author.muid\":{\"value\":\"alice\"}}}"
         )
     , testCase
         "Query multi-or"
@@ -526,49 +534,49 @@ monocleSearchLanguage =
       liftIO $ assertEqual "OnCreatedAndCreated range flavor" (Just expected) q
       withFlavor (Q.QueryFlavor Q.Author Q.UpdatedAt) do
         q' <- prettyQuery
-        let expected' = "{\"range\":{\"updated_at\":{\"boost\":1,\"gt\":\"2021-01-01T00:00:00Z\"}}}"
+        let expected' = "{\"bool\":{\"filter\":[{\"range\":{\"updated_at\":{\"boost\":1,\"gt\":\"2021-01-01T00:00:00Z\"}}}]}}"
         liftIO $ assertEqual "range flavor reset" (Just expected') q'
 
   testSimpleQueryM :: Assertion
   testSimpleQueryM = mkQueryM "author:alice" do
     q <- prettyQuery
-    liftIO $ assertEqual "simple queryM work" (Just "{\"regexp\":{\"author.muid\":{\"flags\":\"ALL\",\"value\":\"alice\"}}}") q
+    liftIO $ assertEqual "simple queryM work" (Just "{\"bool\":{\"filter\":[{\"term\":{\"author.muid\":{\"value\":\"alice\"}}}]}}") q
     dropQuery do
       emptyQ <- prettyQuery
       liftIO $ assertEqual "dropQuery work" Nothing emptyQ
       withModified (const $ Just (S.EqExpr "author" "bob")) do
         newQ <- prettyQuery
-        liftIO $ assertEqual "withModified work" (Just "{\"regexp\":{\"author.muid\":{\"flags\":\"ALL\",\"value\":\"bob\"}}}") newQ
+        liftIO $ assertEqual "withModified work" (Just "{\"bool\":{\"filter\":[{\"term\":{\"author.muid\":{\"value\":\"bob\"}}}]}}") newQ
 
   testEnsureMinBound :: Assertion
   testEnsureMinBound = do
     runEff $ runEmptyQueryM testTenant do
       withQuery (Q.ensureMinBound $ mkCodeQuery "author:alice") do
         got <- prettyQuery
-        let expected = "{\"bool\":{\"must\":[{\"range\":{\"created_at\":{\"boost\":1,\"gt\":\"2021-05-10T00:00:00Z\"}}},{\"regexp\":{\"author.muid\":{\"flags\":\"ALL\",\"value\":\"alice\"}}}]}}"
+        let expected = "{\"bool\":{\"filter\":[{\"bool\":{\"must\":[{\"range\":{\"created_at\":{\"boost\":1,\"gt\":\"2021-05-10T00:00:00Z\"}}},{\"term\":{\"author.muid\":{\"value\":\"alice\"}}}]}}]}}"
         liftIO $ assertEqual "bound ensured with query" (Just expected) got
       withQuery (Q.ensureMinBound $ mkCodeQuery "") do
         got <- prettyQuery
-        let expected = "{\"range\":{\"created_at\":{\"boost\":1,\"gt\":\"2021-05-10T00:00:00Z\"}}}"
+        let expected = "{\"bool\":{\"filter\":[{\"range\":{\"created_at\":{\"boost\":1,\"gt\":\"2021-05-10T00:00:00Z\"}}}]}}"
         liftIO $ assertEqual "match ensured without query" (Just expected) got
 
   testDropDate :: Assertion
   testDropDate = mkQueryM "from:2020 repo:zuul" do
     got <- prettyQuery
-    let expected = "{\"bool\":{\"must\":[{\"range\":{\"created_at\":{\"boost\":1,\"gt\":\"2020-01-01T00:00:00Z\"}}},{\"regexp\":{\"repository_fullname\":{\"flags\":\"ALL\",\"value\":\"zuul\"}}}]}}"
+    let expected = "{\"bool\":{\"filter\":[{\"bool\":{\"must\":[{\"range\":{\"created_at\":{\"boost\":1,\"gt\":\"2020-01-01T00:00:00Z\"}}},{\"term\":{\"repository_fullname\":{\"value\":\"zuul\"}}}]}}]}}"
     liftIO $ assertEqual "match" (Just expected) got
     withModified Q.dropDate do
       newQ <- prettyQuery
-      liftIO $ assertEqual "drop date worked" (Just "{\"regexp\":{\"repository_fullname\":{\"flags\":\"ALL\",\"value\":\"zuul\"}}}") newQ
+      liftIO $ assertEqual "drop date worked" (Just "{\"bool\":{\"filter\":[{\"term\":{\"repository_fullname\":{\"value\":\"zuul\"}}}]}}") newQ
 
   testDropAuthor :: Assertion
   testDropAuthor = mkQueryM "repo:zuul author:john" do
     got <- prettyQuery
-    let expected = "{\"bool\":{\"must\":[{\"regexp\":{\"repository_fullname\":{\"flags\":\"ALL\",\"value\":\"zuul\"}}},{\"regexp\":{\"author.muid\":{\"flags\":\"ALL\",\"value\":\"john\"}}}]}}"
+    let expected = "{\"bool\":{\"filter\":[{\"bool\":{\"must\":[{\"term\":{\"repository_fullname\":{\"value\":\"zuul\"}}},{\"term\":{\"author.muid\":{\"value\":\"john\"}}}]}}]}}"
     liftIO $ assertEqual "match" (Just expected) got
     withModified Q.dropAuthor do
       newQ <- prettyQuery
-      liftIO $ assertEqual "drop date worked" (Just "{\"regexp\":{\"repository_fullname\":{\"flags\":\"ALL\",\"value\":\"zuul\"}}}") newQ
+      liftIO $ assertEqual "drop date worked" (Just "{\"bool\":{\"filter\":[{\"term\":{\"repository_fullname\":{\"value\":\"zuul\"}}}]}}") newQ
 
   -- Get pretty query
   prettyQuery :: MonoQuery :> es => Eff es (Maybe LByteString)